@@ -5,30 +5,46 @@ try:
 except NotImplementedError:
     board = None
     neopixel = None
+import inspect
 import logging
-import uuid
 from abc import ABC, abstractmethod
-from random import random, randint
-from time import time, sleep
-from typing import List
+from functools import lru_cache
+from time import time, sleep, monotonic
 
+import numpy as np
 import paho.mqtt.client as mqtt
 
-from lights.colour import RGBWColour, RGBW
+from lights._colour_fast import channel_order, render_frame
+from lights.colour import RGBWColour, RGBW, rgbw_array, rgbw_linear8
 
 NUM_PIXELS = 300
 
+# Routines which are fading out and have dropped below this weight are no longer evaluated, their last
+# resolved values are reused until they expire
+FROZEN_WEIGHT = 0.02
+
 logger = logging.getLogger(name='lights')
 
 
 class Routine(ABC):
     """
     Superclass of routines which can be stateful and which provide a method to
-    evaluate their current state as an array of RGBW
+    evaluate their current state as an (n,4) uint8 ndarray of linear r, g, b, w values from 0 to 255.
+    Gamma correction is applied later, when routines are combined into the frame sent to the LEDs
     """
 
     @abstractmethod
-    def get_rgbw_array(self, colour_model) -> List[RGBW]:
+    def get_rgbw_array(self, colour_model, out=None) -> np.ndarray:
+        """
+        :param colour_model:
+            an instance of RGBWColour to use when converting to RGBW
+        :param out:
+            if specified, an (n,4) uint8 array into which the result is written. Subclasses may leave
+            this parameter out of their signature, in which case they're never passed it
+        :return:
+            the (n,4) array of r, g, b, w values, which is out if it was specified. Otherwise it may be
+            a view onto the routine's own state, only valid until the routine is next evaluated
+        """
         pass
 
 
@@ -41,12 +57,31 @@ class Rainbows(Routine):
         self.offset = 0
         self.white_value = white_value
         self._n = num_pixels
+        self._table_rgbw = None
+        self._table_key = None
 
-    def get_rgbw_array(self, colour_model):
+    def _build_table(self, colour_model):
+        """
+        Evaluate one full cycle of the rainbow into a uint8 array of r, g, b, w values. Every frame is a
+        circular shift of this cycle, so it only needs rebuilding when the colour model or white value change.
+        The cycle is stored twice over in a (2n,4) array, so every shift is a contiguous slice of it.
+        """
+        colours = colour_model.hsv_to_rgbw_array(hues=4 * np.arange(self._n) / self._n, sats=1.0,
+                                                 values=1.0, white=self.white_value)
+        self._table_rgbw = np.tile(rgbw_linear8(np.clip(colours, 0.0, 1.0)), (2, 1))
+
+    def get_rgbw_array(self, colour_model, out=None):
+        key = id(colour_model), colour_model.version, self.white_value
+        if key != self._table_key:
+            self._build_table(colour_model)
+            self._table_key = key
         self.offset = (self.offset + 1) % self._n
-        return [colour_model.hsv_to_rgbw(hue=4 * ((i + self.offset) % self._n) / self._n, sat=1.0, value=1.0,
-                                         white=self.white_value)
-                for i in range(self._n)]
+        # Equivalent to np.roll on a single cycle, without any copying unless out is specified
+        colours = self._table_rgbw[self.offset:self.offset + self._n]
+        if out is None:
+            return colours
+        np.copyto(out, colours)
+        return out
 
 
 class Sparkle(Routine):
@@ -69,30 +104,50 @@ class Sparkle(Routine):
         """
         self.base_hue = base_hue
         self.hue_range = hue_range
-        self._p = [(self.random_colour(), 0) for _ in range(NUM_PIXELS)]
+        # Hue and brightness of each pixel. Brightness is a view into a buffer with an extra element at
+        # each end, which hold copies of the opposite ends of the strip so the smear can wrap without
+        # any modulo or rolled copies
+        self._h = self.random_colour(NUM_PIXELS)
+        self._padded_b = np.zeros(NUM_PIXELS + 2, dtype=np.float32)
+        self._b = self._padded_b[1:-1]
+        self._smear = np.zeros(NUM_PIXELS, dtype=np.float32)
         self.new_sparks = new_sparks
         self.fade_factor = fade_factor
 
-    def random_colour(self):
-        return self.base_hue + (random() * 2.0 - 1.0) * self.hue_range
-
-    def smear_brightness(self, pixel):
-        a, b, c = [self._p[(pixel + i) % NUM_PIXELS] for i in range(-1, 2)]
-        return b[0], (a[1] + b[1] * 2 + c[1]) / 4
-
-    def get_rgbw_array(self, colour_model):
-        # Fade everything a bit
-        self._p = list([(h, b * self.fade_factor) for h, b in self._p])
-        # Smear brightness values
-        self._p = [self.smear_brightness(i) for i in range(NUM_PIXELS)]
-        for _ in range(self.new_sparks):
-            self._p[randint(0, NUM_PIXELS - 1)] = self.random_colour(), 1.0
-        return [colour_model.hsv_to_rgbw(h, 1.0, b, white=0.4 * b) for h, b in self._p]
+    def random_colour(self, size):
+        """
+        Create an array of random hues within hue_range of base_hue
+        """
+        return (self.base_hue + (np.random.rand(size) * 2.0 - 1.0) * self.hue_range).astype(np.float32)
+
+    def get_rgbw_array(self, colour_model, out=None):
+        # Smear brightness values with a wrapping [1, 2, 1] / 4 filter, and fade everything a bit. The
+        # filter is linear so the fade can be folded into its scale factor rather than a separate pass
+        padded = self._padded_b
+        padded[0], padded[-1] = padded[-2], padded[1]
+        np.add(padded[:-2], padded[2:], out=self._smear)
+        self._smear += self._b
+        self._smear += self._b
+        np.multiply(self._smear, 0.25 * self.fade_factor, out=self._b)
+        spark_idx = np.random.randint(0, NUM_PIXELS, self.new_sparks)
+        self._h[spark_idx] = self.random_colour(self.new_sparks)
+        self._b[spark_idx] = 1.0
+        return colour_model.hsv_to_rgbw_bulk(self._h, self._b, white=0.4 * self._b, out=out)
+
+
+@lru_cache(maxsize=None)
+def _accepts_out(routine_class):
+    """
+    Whether the get_rgbw_array method of a Routine subclass accepts an out argument. Routines written
+    before out was added only take colour_model, and are called without it. Checked once per class.
+    """
+    parameters = inspect.signature(routine_class.get_rgbw_array).parameters.values()
+    return any(p.name == 'out' or p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters)
 
 
 class Lights:
 
-    def __init__(self, colour_model=RGBWColour(), n=NUM_PIXELS, fade_duration=1):
+    def __init__(self, colour_model=RGBWColour(), n=NUM_PIXELS, fade_duration=1, target_fps=30):
         """
         :param colour_model:
             an instance of RGBWColour to manage gamma etc
@@ -100,6 +155,8 @@ class Lights:
             number of LEDs in the associated hardware
         :param fade_duration:
             time in seconds over which to fade in a newly assigned routine
+        :param target_fps:
+            number of frames per second the main loop should aim to call show()
         """
         self._n = n
         if neopixel:
@@ -107,14 +164,32 @@ class Lights:
                                              n=self._n,
                                              pixel_order=neopixel.GRBW,
                                              auto_write=False)
+            self._channel_order = channel_order(neopixel.GRBW)
         else:
             logger.info('No neopixel driver available, proceeding in dummy mode')
         self._colour_model = colour_model
-        self._routines = {}
+        # list of [id, routine, weight, buffer] slots, there are rarely more than two or three so these
+        # are scanned linearly rather than held in a dict. The buffer holds a snapshot of the routine's
+        # resolved values once it has almost faded out, and is None until then
+        self._routines = []
         self._active_routine = None
+        # routines are identified by an increasing integer, assigned from this counter
+        self._routine_counter = 0
+        # total of all routine weights, with a minimum of 1.0, updated whenever the weights change
+        self._total_weight = 1.0
         # fade time in seconds
         self._fade_duration = fade_duration
         self._last_fade_time = time()
+        self._target_fps = max(1.0, target_fps)
+        # bytes of the last frame pushed to the strip, used to skip pushing unchanged frames
+        self._last_pixels8 = None
+        # Buffers reused across frames. Each routine's resolved values are copied into a slice of
+        # scratch so they can be combined in one call, it is grown if more routines than it has room
+        # for are active at once
+        self._scratch = np.zeros((8, self._n, 4), dtype=np.uint8)
+        self._pixels8 = np.zeros((self._n, 4), dtype=np.uint8)
+        # resolved values of constant routines, cleared whenever the set of routines changes
+        self._constant_cache = {}
 
     def _fade_routines(self):
         now = time()
@@ -122,57 +197,133 @@ class Lights:
         # other routines. Calculated from the fade duration and the elapsed time since the last fade
         fade = (now - self._last_fade_time) * (1 / self._fade_duration)
         self._last_fade_time = now
-        # increment the weight of the active routine, decrement all others, and produce a new dict of
-        # routines containing only those with weights greater than zero. This in effect causes older
-        # routines to expire once they're no longer visible
-        self._routines = {
-            r_id: (r, max(0.0, d - fade) if r_id != self._active_routine else min(1.0, d + fade)) for
-            r_id, (r, d) in
-            self._routines.items() if d > fade or r_id == self._active_routine}
-
-    def _resolve(self, routine):
+        # increment the weight of the active routine, decrement all others, and keep only those
+        # routines with weights greater than zero. This in effect causes older routines to expire once
+        # they're no longer visible
+        for slot in self._routines:
+            slot[2] = min(1.0, slot[2] + fade) if slot[0] == self._active_routine else slot[2] - fade
+        routine_count = len(self._routines)
+        self._routines = [slot for slot in self._routines if slot[2] > 0 or slot[0] == self._active_routine]
+        if len(self._routines) != routine_count:
+            self._constant_cache.clear()
+        self._total_weight = max(1.0, sum(slot[2] for slot in self._routines))
+
+    def _resolve(self, routine, out):
         """
         Evaluate a routine. This can accept a constant tuple of either H,S,V or R,G,B,W values
         with all values ranging from 0.0 to 1.0, or a Routine which can be called to generate
         the appropriate values.
 
-        Returns an array of RGBW of length of the number of LEDs in this light
+        Writes an (n,4) uint8 array of r, g, b, w values into out, where n is the number of LEDs in this
+        light, and returns it
+        """
+        if isinstance(routine, Routine):
+            if _accepts_out(type(routine)):
+                colours = routine.get_rgbw_array(colour_model=self._colour_model, out=out)
+            else:
+                colours = routine.get_rgbw_array(colour_model=self._colour_model)
+            if colours is not out:
+                # Tolerate routines which don't take or ignore out, or return a list of RGBW or 0.0 to 1.0 floats
+                if not isinstance(colours, np.ndarray):
+                    colours = rgbw_array(colours)
+                if colours.dtype == np.uint8:
+                    out[:] = colours
+                else:
+                    rgbw_linear8(np.clip(colours, 0.0, 1.0), out=out)
+        else:
+            out[:] = self._resolve_constant(routine)
+        return out
+
+    def _resolve_constant(self, routine):
+        """
+        Evaluate a constant routine, either an H,S,V or R,G,B,W tuple or an RGBW, to a single uint8 r, g, b, w
+        row which can be broadcast across all LEDs. Results are cached, keyed on the routine and the version
+        of the colour model, until the set of routines changes.
         """
-        if isinstance(routine, tuple):
-            if len(routine) == 3:
+        key = id(routine), self._colour_model.version
+        rgbw = self._constant_cache.get(key)
+        if rgbw is None:
+            if isinstance(routine, tuple) and len(routine) == 3:
                 # treat as constant HSV
-                return [self._colour_model.hsv_to_rgbw(*routine)] * self._n
-            elif len(routine) == 4:
-                # treat as constant RGBW
-                return [RGBW(*routine)] * self._n
+                rgbw = np.clip(rgbw_array([self._colour_model.hsv_to_rgbw(*routine)]), 0.0, 1.0)
             else:
-                raise ValueError(f'Unable to create a routine from {routine}')
-        elif isinstance(routine, Routine):
-            return routine.get_rgbw_array(colour_model=self._colour_model)
-        elif isinstance(routine, RGBW):
-            return [routine] * self._n
+                if isinstance(routine, tuple) and len(routine) == 4:
+                    # treat as constant RGBW
+                    rgbw = np.clip(np.array([routine], dtype=np.float32), 0.0, 1.0)
+                elif isinstance(routine, RGBW):
+                    rgbw = np.clip(rgbw_array([routine]), 0.0, 1.0)
+                else:
+                    raise ValueError(f'Unable to create a routine from {routine}')
+                # Constant RGBW values are raw drive values, so undo the gamma which is applied to r, g, b
+                # when the frame is rendered
+                if self._colour_model.gamma > 0:
+                    rgbw[:, :3] **= 1 / self._colour_model.gamma
+            self._constant_cache[key] = rgbw = rgbw_linear8(rgbw)
+        return rgbw
 
     def show(self):
         # Only run if there are routines to show
         if self._routines:
             # Get the total weights, this is always at least 1.0 so we can fade from
             # black without problems when there's only a single routine
-            total_weight = self.weights
-            # For each routine, multiply every evaluated rgbw value by the proportion of
-            # the total weight contributed by this routine
-            weighted_routines = [[rgbw * (d / total_weight) for rgbw in self._resolve(routine)] for _, (routine, d) in
-                                 self._routines.items()]
-            # Zip all resolved routines together and add the rgbw values at each position
-            # to get an array of rgbw
-            colours = [sum(x) for x in zip(*weighted_routines)] if weighted_routines else [RGBW(0, 0, 0, 0)] * self._n
+            total_weight = self._total_weight
+            if len(self._routines) > len(self._scratch):
+                self._scratch = np.zeros((len(self._routines), self._n, 4), dtype=np.uint8)
+            # Resolve each routine into scratch, along with the proportion of the total weight contributed
+            # by that routine as a fixed point fraction of 256. Routines which are almost faded out are
+            # snapshotted the first time they're resolved below FROZEN_WEIGHT, and reuse the snapshot from
+            # then on rather than being evaluated again
+            weights = np.empty(len(self._routines), dtype=np.uint16)
+            for k, slot in enumerate(self._routines):
+                r_id, routine, d, frozen = slot
+                if frozen is not None:
+                    self._scratch[k] = frozen
+                else:
+                    self._resolve(routine, out=self._scratch[k])
+                    if d < FROZEN_WEIGHT and r_id != self._active_routine:
+                        slot[3] = self._scratch[k].copy()
+                weights[k] = int(d / total_weight * 256)
             if neopixel:
-                # Copy colour values to the actual hardware and update the strip
-                for i, rgbw in enumerate(colours):
-                    self._pixels[i] = rgbw.rgbw8
-                self._pixels.show()
+                # Sum the weighted routines and convert to gamma corrected 0-255 values in one pass
+                pixels8 = render_frame(self._scratch[:len(self._routines)], weights,
+                                       self._colour_model.gamma_lut8, self._pixels8)
+                # Only push to the strip if the frame differs from the last one pushed, so static
+                # routines don't pay the cost of writing out every pixel every frame
+                pixels8_bytes = pixels8.tobytes()
+                if pixels8_bytes != self._last_pixels8:
+                    self._last_pixels8 = pixels8_bytes
+                    # Copy colour values to the actual hardware and update the strip
+                    self._write_pixels(pixels8)
+                    self._pixels.show()
             # Fade any routines, bringing the active one into view and fading others away
             self._fade_routines()
 
+    def _write_pixels(self, pixels8):
+        """
+        Copy an (n,4) uint8 frame into the neopixel driver. Where the driver's byte buffers are available
+        the whole frame is written in one assignment, with channels reordered to match the strip, rather
+        than setting each pixel in turn.
+        """
+        pixels = self._pixels
+        if hasattr(pixels, '_post_brightness_buffer'):
+            # adafruit_pixelbuf based drivers. Once brightness has been set below 1.0 the driver keeps the
+            # unscaled values in _pre_brightness_buffer, and the scaled values it transmits in
+            # _post_brightness_buffer, truncating as it does when setting a single pixel
+            ordered = pixels8[:, self._channel_order]
+            start = pixels._offset
+            end = start + ordered.nbytes
+            if pixels._pre_brightness_buffer is not None:
+                pixels._pre_brightness_buffer[start:end] = ordered.tobytes()
+                ordered = (ordered * pixels.brightness).astype(np.uint8)
+            pixels._post_brightness_buffer[start:end] = ordered.tobytes()
+        elif hasattr(pixels, 'buf'):
+            # Older neopixel drivers, which hold unscaled values and apply brightness on show()
+            offset = getattr(pixels, 'byteoffset', 0)
+            pixels.buf[offset:offset + pixels8.nbytes] = pixels8[:, self._channel_order].tobytes()
+        else:
+            for i, rgbw in enumerate(pixels8.tolist()):
+                pixels[i] = tuple(rgbw)
+
     @property
     def brightness(self):
         if neopixel:
@@ -183,6 +334,8 @@ class Lights:
     def brightness(self, value):
         if neopixel:
             self._pixels.brightness = value
+            # Brightness is applied by the driver, so force the next frame to be pushed
+            self._last_pixels8 = None
 
     @property
     def fade(self):
@@ -192,11 +345,23 @@ class Lights:
     def fade(self, value):
         self._fade_duration = max(0.01, value)
 
+    @property
+    def target_fps(self):
+        """
+        Frame rate the main loop paces calls to show() against
+        """
+        return self._target_fps
+
+    @target_fps.setter
+    def target_fps(self, value):
+        self._target_fps = max(1.0, value)
+
     @property
     def routine(self):
-        if self._active_routine is None:
-            return None
-        return self._routines[self._active_routine][0]
+        for r_id, r, _, _ in self._routines:
+            if r_id == self._active_routine:
+                return r
+        return None
 
     @routine.setter
     def routine(self, r):
@@ -207,15 +372,17 @@ class Lights:
         :param r:
             A routine, this can be anything the _resolve function can use.
         """
-        self._active_routine = str(uuid.uuid4())
-        self._routines[self._active_routine] = r, 0
+        self._routine_counter += 1
+        self._active_routine = self._routine_counter
+        self._routines.append([self._active_routine, r, 0.0, None])
+        self._constant_cache.clear()
 
     @property
     def weights(self):
         """
         Total of all the routine weights, with a minimum of 1.0
         """
-        return max(1.0, sum([d for _, (_, d) in self._routines.items()]))
+        return self._total_weight
 
     @property
     def n(self) -> int:
@@ -289,7 +456,14 @@ class DimmerSwitch:
 lights = Lights(colour_model=RGBWColour(), n=NUM_PIXELS)
 # Create and start an MQTT listener, linking it to the controlled lights
 dimmer = DimmerSwitch(switch_name='kitchen_led_control', client_name='kitchen_client', lights=lights)
-# Loop, with a small delay to ease off CPU usage on the pi
+# Loop, sleeping until the next frame is due to ease off CPU usage on the pi. If a frame overruns
+# the schedule is reset rather than trying to catch up with a burst of frames
+next_frame_time = monotonic()
 while True:
     lights.show()
-    sleep(0.005)
+    next_frame_time += 1 / lights.target_fps
+    slack = next_frame_time - monotonic()
+    if slack > 0:
+        sleep(slack)
+    else:
+        next_frame_time = monotonic()
@@ -0,0 +1,127 @@
+"""
+Array kernels for hsv to rgbw conversion and frame rendering, compiled with numba where it's available.
+Without numba equivalent vectorised numpy implementations are used instead. Also holds the channel
+reordering used when writing rendered frames to the strip.
+"""
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+import numpy as np
+
+# Order in which (c, x, 0) are assigned to (r, g, b) for each sextant of the hue circle
+RGB_PERM = np.array([[0, 1, 2], [1, 0, 2], [2, 0, 1], [2, 1, 0], [1, 2, 0], [0, 2, 1]], dtype=np.intp)
+
+
+def _hsv_to_rgbw_loop(hues, sats, values, whites, saturation, brightness, out):
+    """
+    Convert arrays of hsv colours to rgbw, using the same algorithm as RGBWColour.hsv_to_rgbw
+
+    :param hues:
+        1D float array of hues, 0.0 to 1.0 (but other values will wrap)
+    :param sats:
+        1D float array of saturations, 0.0 to 1.0
+    :param values:
+        1D float array of values, 0.0 to 1.0
+    :param whites:
+        1D float array of explicit white LED values, or None to derive white from saturation
+    :param saturation:
+        Saturation correction of the colour model
+    :param brightness:
+        Brightness of the colour model
+    :param out:
+        (n,4) float32 array into which r, g, b, w values are written
+    :return:
+        The out array
+    """
+    for i in range(hues.shape[0]):
+        sat = sats[i] ** (1 / saturation) if saturation > 0 else 0.0
+        c = values[i] * brightness * sat
+        h6 = (hues[i] % 1.0) * 6.0
+        x = c * (1 - abs(h6 % 2 - 1))
+        cx0 = (c, x, 0.0)
+        perm = RGB_PERM[int(h6) % 6]
+        out[i, 0] = cx0[perm[0]]
+        out[i, 1] = cx0[perm[1]]
+        out[i, 2] = cx0[perm[2]]
+        if whites is None:
+            out[i, 3] = (1 - sat) * values[i] * brightness
+        else:
+            out[i, 3] = whites[i] * brightness
+    return out
+
+
+def _hsv_to_rgbw_numpy(hues, sats, values, whites, saturation, brightness, out):
+    """
+    Vectorised numpy equivalent of _hsv_to_rgbw_loop, used when numba isn't available
+    """
+    sat = sats ** (1 / saturation) if saturation > 0 else np.zeros_like(sats)
+    c = values * brightness * sat
+    h6 = (hues % 1.0) * 6.0
+    x = c * (1 - np.abs(h6 % 2 - 1))
+    cx0 = np.stack([c, x, np.zeros_like(c)], axis=-1)
+    out[:, :3] = np.take_along_axis(cx0, RGB_PERM[h6.astype(np.intp) % 6], axis=1)
+    out[:, 3] = (1 - sat) * values * brightness if whites is None else whites * brightness
+    return out
+
+
+def _render_frame_loop(resolved, weights, gamma_lut8, out):
+    """
+    Combine resolved routines into a frame of 0-255 pixel values, with gamma applied to the r, g, b channels.
+    All arithmetic is integer, weights are fixed point fractions of 256 and each weighted value is shifted
+    back down before accumulating, so the total never exceeds 255 when the weights sum to at most 256.
+
+    :param resolved:
+        (k,n,4) uint8 array of linear r, g, b, w values for each of k routines
+    :param weights:
+        1D uint16 array of k weights, one per routine, as fractions of 256 summing to at most 256
+    :param gamma_lut8:
+        256 entry uint8 array mapping linear 0-255 values to gamma corrected ones
+    :param out:
+        (n,4) uint8 array into which the frame is written
+    :return:
+        The out array
+    """
+    for i in prange(resolved.shape[1]):
+        for c in range(4):
+            acc = 0
+            for k in range(resolved.shape[0]):
+                acc += (resolved[k, i, c] * weights[k]) >> 8
+            out[i, c] = gamma_lut8[acc] if c < 3 else acc
+    return out
+
+
+def _render_frame_numpy(resolved, weights, gamma_lut8, out):
+    """
+    Vectorised numpy equivalent of _render_frame_loop, used when numba isn't available
+    """
+    acc = np.zeros(resolved.shape[1:], dtype=np.uint16)
+    weighted = np.empty(resolved.shape[1:], dtype=np.uint16)
+    for routine, weight in zip(resolved, weights):
+        np.multiply(routine, weight, out=weighted, dtype=np.uint16)
+        weighted >>= 8
+        acc += weighted
+    np.copyto(out, acc, casting='unsafe')
+    out[:, :3] = gamma_lut8[out[:, :3]]
+    return out
+
+
+def channel_order(pixel_order):
+    """
+    Given a neopixel pixel order, either a string such as 'GRBW' or a tuple of the byte position of
+    each of r, g, b, w, return the indices of the r, g, b, w channels in the order the strip expects
+    """
+    if isinstance(pixel_order, str):
+        pixel_order = [pixel_order.index(channel) for channel in 'RGBW']
+    return np.argsort(pixel_order)
+
+
+if njit is not None:
+    hsv_to_rgbw = njit(cache=True, fastmath=True)(_hsv_to_rgbw_loop)
+    # The frame is spread across cores by pixel, pushing it to the strip remains serial
+    render_frame = njit(parallel=True, cache=True, fastmath=True)(_render_frame_loop)
+else:
+    hsv_to_rgbw = _hsv_to_rgbw_numpy
+    render_frame = _render_frame_numpy
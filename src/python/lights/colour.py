@@ -1,4 +1,13 @@
-import colorsys
+import numpy as np
+
+from lights._colour_fast import RGB_PERM, hsv_to_rgbw as _hsv_to_rgbw_kernel
+
+# Resolution of the hue and value axes of the lookup table used by RGBWColour.hsv_to_rgbw_bulk
+H_BINS = 256
+V_BINS = 64
+
+# RGB_PERM as nested tuples, indexing these is cheaper than indexing an ndarray for a single colour
+_RGB_PERM = tuple(tuple(perm) for perm in RGB_PERM.tolist())
 
 
 class RGBWColour:
@@ -11,6 +20,19 @@ class RGBWColour:
         self._gamma = 2.0
         self._saturation = 2.0
         self._brightness = 1.0
+        self._version = 0
+        self._lut = None
+        self._gamma_lut8 = None
+        self._build_lut()
+        self._build_gamma_lut8()
+
+    @property
+    def version(self):
+        """
+        Counter incremented whenever any colour parameter changes, used by routines to invalidate
+        any values they have precomputed with this colour model
+        """
+        return self._version
 
     @property
     def brightness(self):
@@ -18,7 +40,8 @@ class RGBWColour:
 
     @brightness.setter
     def brightness(self, value):
-        self._brightness = max(0, 0, min(value, 1.0))
+        self._brightness = min(1.0, max(0.0, float(value)))
+        self._invalidate()
 
     @property
     def saturation(self):
@@ -27,6 +50,7 @@ class RGBWColour:
     @saturation.setter
     def saturation(self, value):
         self._saturation = max(0.0, value)
+        self._invalidate()
 
     @property
     def gamma(self):
@@ -35,6 +59,89 @@ class RGBWColour:
     @gamma.setter
     def gamma(self, value):
         self._gamma = max(0.0, value)
+        self._invalidate()
+
+    def _invalidate(self):
+        """
+        Called when any colour parameter changes, bumps the version and rebuilds the lookup tables
+        """
+        self._version += 1
+        self._build_lut()
+        self._build_gamma_lut8()
+
+    def _build_lut(self):
+        """
+        Build a (H_BINS, V_BINS, 4) table of uint8 rgbw values for fully saturated colours, indexed by
+        quantized hue and value, with brightness already applied. Values are linear, gamma is applied when
+        the frame is rendered.
+        """
+        hues, values = np.meshgrid(np.arange(H_BINS) / H_BINS, np.arange(V_BINS) / (V_BINS - 1), indexing='ij')
+        self._lut = rgbw_linear8(self.hsv_to_rgbw_array(hues=hues.ravel(), sats=1.0, values=values.ravel())).reshape(
+            (H_BINS, V_BINS, 4))
+
+    def _build_gamma_lut8(self):
+        """
+        Build a 256 entry table mapping linear 0-255 values to gamma corrected 0-255 values
+        """
+        self._gamma_lut8 = np.array([round(255 * (i / 255) ** self._gamma) for i in range(256)], dtype=np.uint8)
+
+    @property
+    def gamma_lut8(self) -> np.ndarray:
+        """
+        256 entry uint8 table mapping linear 0-255 values to gamma corrected 0-255 values
+        """
+        return self._gamma_lut8
+
+    def hsv_to_rgbw_array(self, hues, sats, values, white=None) -> np.ndarray:
+        """
+        Convert arrays of hsv colours to an (n,4) array of rgbw values, using the same algorithm as
+        hsv_to_rgbw but evaluated over whole arrays at once. Arguments may be arrays or scalars, and
+        are broadcast against each other.
+
+        :param hues:
+            Hues, 0.0 to 1.0 (but other values will wrap)
+        :param sats:
+            Saturations, 0.0 to 1.0
+        :param values:
+            Values, 0.0 to 1.0
+        :param white:
+            If specified, explicitly set the white LED to this value. Defaults to None, in which
+            case the white LED value is set from the hsv->rgbw algorithm
+        :return:
+            An (n,4) float32 array of r, g, b, w values
+        """
+        arrays = [hues, sats, values] + ([] if white is None else [white])
+        arrays = [np.ascontiguousarray(a, dtype=np.float64) for a in np.broadcast_arrays(*np.atleast_1d(*arrays))]
+        out = np.empty((len(arrays[0]), 4), dtype=np.float32)
+        return _hsv_to_rgbw_kernel(arrays[0], arrays[1], arrays[2], arrays[3] if white is not None else None,
+                                   self._saturation, self._brightness, out)
+
+    def hsv_to_rgbw_bulk(self, hues, values, white=None, out=None) -> np.ndarray:
+        """
+        Convert arrays of fully saturated hsv colours to an (n,4) array of linear 0-255 uint8 rgbw values, as
+        returned by routines. Uses a lookup table rather than evaluating hsv_to_rgbw for each colour, so hue
+        and value are quantized to H_BINS and V_BINS levels respectively.
+
+        :param hues:
+            Array of hues, 0.0 to 1.0 (but other values will wrap)
+        :param values:
+            Array of values, 0.0 to 1.0
+        :param white:
+            If specified, explicitly set the white LED to this value, either a scalar or an array of the
+            same length as hues. Defaults to None, in which case the white LED is off
+        :param out:
+            If specified, an (n,4) uint8 array into which the result is written
+        :return:
+            An (n,4) uint8 array of r, g, b, w values, which is out if it was specified
+        """
+        h_idx = np.floor(np.asarray(hues) * H_BINS).astype(np.intp) % H_BINS
+        v_idx = np.rint(np.asarray(values) * (V_BINS - 1)).astype(np.intp).clip(0, V_BINS - 1)
+        # Index the table as a flat array of colours, so the lookup can write directly into out. The indices are
+        # already in range, clip mode stops numpy from buffering out in case an out of range index raises
+        colours = np.take(self._lut.reshape(-1, 4), h_idx * V_BINS + v_idx, axis=0, out=out, mode='clip')
+        if white is not None:
+            rgbw_linear8(np.asarray(white) * self._brightness, out=colours[:, 3])
+        return colours
 
     def hsv_to_rgbw(self, hue, sat, value, white=None):
         """
@@ -42,8 +149,8 @@ class RGBWColour:
         to the colour after setting saturation to 1.0, then blending in an amount of the white chip. When
         the target saturation is less than 1, this is also used to scale the brightness of the colour component
         back, so very low saturation produces very dim colours along with a predominant white component. This
-        isn't particularly scientific, but produces plausible results. RGB values are modified by the gamma
-        value set on this colour space.
+        isn't particularly scientific, but produces plausible results. RGB values are linear, the gamma
+        value set on this colour space is applied through gamma_lut8 when render_frame builds the frame.
 
         :param hue:
             Hue, 0.0 to 1.0 (but other values will wrap)
@@ -57,15 +164,21 @@ class RGBWColour:
         :return:
         """
         sat = sat ** (1 / self._saturation) if self._saturation > 0 else 0
-        r, g, b = colorsys.hsv_to_rgb(hue, 1.0, value * self._brightness * sat)
+        # Equivalent to colorsys.hsv_to_rgb(hue, 1.0, c), but picks the sextant of the hue circle by
+        # indexing a permutation table rather than with a chain of comparisons
+        c = value * self._brightness * sat
+        h6 = (hue % 1.0) * 6.0
+        cx0 = c, c * (1 - abs(h6 % 2 - 1)), 0.0
+        p_r, p_g, p_b = _RGB_PERM[int(h6) % 6]
+        r, g, b = cx0[p_r], cx0[p_g], cx0[p_b]
         w = (1 - sat) * value * self._brightness if white is None else white * self._brightness
-        return RGBW(r ** self._gamma, g ** self._gamma, b ** self._gamma, w)
+        return RGBW(r, g, b, w)
 
 
 class RGBW:
     """
-    Represents a single RGBW tuple, with convenience methods to scale or add two tuples together. All values
-    are 0.0 to 1.0
+    Represents a single RGBW tuple, used for constant colours. All values are 0.0 to 1.0. Arrays of
+    colours are held as (n,4) ndarrays rather than lists of RGBW, see rgbw_array and rgbw_linear8
     """
 
     def __init__(self, r, g, b, w):
@@ -74,35 +187,27 @@ class RGBW:
         self.b = b
         self.w = w
 
-    def __add__(self, other):
-        if isinstance(other, RGBW):
-            return RGBW(r=self.r + other.r,
-                        g=self.g + other.g,
-                        b=self.b + other.b,
-                        w=self.w + other.w)
-        return self
-
-    def __radd__(self, other):
-        return self.__add__(other)
-
-    def __mul__(self, other):
-        return RGBW(r=self.r * other,
-                    g=self.g * other,
-                    b=self.b * other,
-                    w=self.w * other)
-
-    def __rmul__(self, other):
-        return self.__mul__(other)
-
     def __str__(self):
         return f'rgbw({self.r},{self.g},{self.b},{self.w})'
 
     def __repr__(self):
         return self.__str__()
 
-    @property
-    def rgbw8(self):
-        """
-        Get a 0-255 version of the r, g, b, w values, as used by a neopixel or similar
-        """
-        return self.r * 255, self.g * 255, self.b * 255, self.w * 255
+
+def rgbw_array(colours) -> np.ndarray:
+    """
+    Convert a sequence of RGBW to an (n,4) float32 array of r, g, b, w values
+    """
+    return np.array([(c.r, c.g, c.b, c.w) for c in colours], dtype=np.float32).reshape(-1, 4)
+
+
+def rgbw_linear8(colours, out=None) -> np.ndarray:
+    """
+    Quantize linear r, g, b, w values from 0.0 to 1.0 into 0-255 uint8 values, without applying gamma. Values
+    must already be within 0.0 to 1.0, they are not clipped. If out is specified the result is written into it.
+    """
+    colours = np.rint(np.asarray(colours) * 255)
+    if out is None:
+        return colours.astype(np.uint8)
+    np.copyto(out, colours, casting='unsafe')
+    return out
@@ -14,8 +14,10 @@ setup(
     author='Tom Oinn',
     author_email='tomoinn@gmail.com',
     license='ASL2.0',
-    packages=find_namespace_packages(),
-    install_requires=['gevent', 'flask', 'adafruit-blinka', 'adafruit-circuitpython-neopixel', 'paho-mqtt'],
+    packages=find_namespace_packages(include=['lights', 'lights.*']),
+    install_requires=['numpy', 'gevent', 'flask', 'adafruit-blinka', 'adafruit-circuitpython-neopixel', 'paho-mqtt'],
+    # numba is optional, if installed the colour conversion and frame rendering kernels are compiled
+    extras_require={'fast': ['numba']},
     include_package_data=True,
     test_suite='nose.collector',
     tests_require=['nose'],
@@ -0,0 +1,100 @@
+import colorsys
+import importlib.util
+import os
+import sys
+import unittest
+
+import numpy as np
+
+
+def load(name):
+    # Importing through the lights package would run the main loop and need the LED hardware, so load
+    # the module directly from its file, registered under its real name so the modules can import each other
+    spec = importlib.util.spec_from_file_location(
+        f'lights.{name}', os.path.join(os.path.dirname(__file__), '..', 'lights', f'{name}.py'))
+    module = sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+load('_colour_fast')
+colour = load('colour')
+
+
+class RGBWColourTest(unittest.TestCase):
+
+    def test_brightness_clamped(self):
+        colour_model = colour.RGBWColour()
+        for brightness, expected in ((-1, 0.0), (0.3, 0.3), (2, 1.0)):
+            colour_model.brightness = brightness
+            self.assertEqual(colour_model.brightness, expected)
+
+
+class HsvToRgbwTest(unittest.TestCase):
+
+    def test_matches_colorsys(self):
+        colour_model = colour.RGBWColour()
+        # Include the boundaries between sextants of the hue circle as well as points within them
+        for hue in np.concatenate([np.arange(7) / 6, np.random.default_rng(0).random(200)]):
+            for value in (0.0, 0.25, 1.0):
+                rgbw = colour_model.hsv_to_rgbw(hue, 1.0, value)
+                self.assertEqual((rgbw.r, rgbw.g, rgbw.b), colorsys.hsv_to_rgb(hue % 1.0, 1.0, value))
+                self.assertEqual(rgbw.w, 0.0)
+
+    def test_hue_wraps(self):
+        colour_model = colour.RGBWColour()
+        for hue in (0.125, 0.5, 0.875):
+            expected = colour_model.hsv_to_rgbw(hue, 0.7, 0.6)
+            for wrapped in (hue - 1, hue + 1, hue + 2):
+                actual = colour_model.hsv_to_rgbw(wrapped, 0.7, 0.6)
+                np.testing.assert_allclose([actual.r, actual.g, actual.b, actual.w],
+                                           [expected.r, expected.g, expected.b, expected.w], atol=1e-12)
+
+
+class HsvToRgbwBulkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.colour_model = colour.RGBWColour()
+        rng = np.random.default_rng(0)
+        self.hues = rng.random(1000)
+        self.values = rng.random(1000)
+
+    def test_matches_hsv_to_rgbw_array(self):
+        expected = colour.rgbw_linear8(self.colour_model.hsv_to_rgbw_array(self.hues, 1.0, self.values))
+        actual = self.colour_model.hsv_to_rgbw_bulk(self.hues, self.values)
+        self.assertEqual(actual.dtype, np.uint8)
+        # Hues are floored to one of H_BINS bins, and r, g, b change by up to six times the hue change. Values
+        # are rounded to the nearest of V_BINS levels. Each side is then rounded to a whole 0-255 level
+        tolerance = 6 * 255 / colour.H_BINS + 255 / (2 * (colour.V_BINS - 1)) + 1
+        self.assertLessEqual(np.abs(actual.astype(int) - expected).max(), tolerance)
+
+    def test_hue_wraps(self):
+        # Exact multiples of the bin width, so wrapping can't move a hue across a bin boundary
+        hues = np.arange(colour.H_BINS) / colour.H_BINS
+        expected = self.colour_model.hsv_to_rgbw_bulk(hues, np.ones_like(hues))
+        for offset in (-1, 1, 2):
+            np.testing.assert_array_equal(self.colour_model.hsv_to_rgbw_bulk(hues + offset, np.ones_like(hues)),
+                                          expected)
+
+    def test_values_clip(self):
+        np.testing.assert_array_equal(self.colour_model.hsv_to_rgbw_bulk(self.hues, np.full(1000, -0.5)),
+                                      self.colour_model.hsv_to_rgbw_bulk(self.hues, np.zeros(1000)))
+        np.testing.assert_array_equal(self.colour_model.hsv_to_rgbw_bulk(self.hues, np.full(1000, 1.5)),
+                                      self.colour_model.hsv_to_rgbw_bulk(self.hues, np.ones(1000)))
+
+    def test_white(self):
+        self.colour_model.brightness = 0.5
+        plain = self.colour_model.hsv_to_rgbw_bulk(self.hues, self.values)
+        np.testing.assert_array_equal(plain[:, 3], 0)
+        whites = np.random.default_rng(1).random(1000)
+        for white in (0.4, whites):
+            out = np.empty((1000, 4), dtype=np.uint8)
+            actual = self.colour_model.hsv_to_rgbw_bulk(self.hues, self.values, white=white, out=out)
+            self.assertIs(actual, out)
+            # White is scaled by brightness, and leaves r, g, b alone
+            np.testing.assert_array_equal(actual[:, :3], plain[:, :3])
+            np.testing.assert_array_equal(actual[:, 3], np.rint(np.broadcast_to(white, 1000) * 0.5 * 255))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import colorsys
+import importlib.util
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# Importing through the lights package would run the main loop and need the LED hardware, but
+# _colour_fast has no dependencies within the package so it can be loaded directly from its file.
+# It's registered under its real name so anything numba caches for it is reusable by the package.
+_spec = importlib.util.spec_from_file_location(
+    'lights._colour_fast', os.path.join(os.path.dirname(__file__), '..', 'lights', '_colour_fast.py'))
+colour_fast = sys.modules[_spec.name] = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(colour_fast)
+
+
+def random_hsv(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # Hues deliberately include values outside 0.0 to 1.0, which should wrap
+    return rng.random(n) * 3 - 1, rng.random(n), rng.random(n), rng.random(n)
+
+
+def random_frame(k, n, seed=0):
+    rng = np.random.default_rng(seed)
+    resolved = rng.integers(0, 256, (k, n, 4), dtype=np.uint8)
+    # Fixed point weights which sum to exactly 256, the largest total show() produces
+    cuts = np.sort(rng.integers(0, 257, k - 1))
+    weights = np.diff(np.concatenate([[0], cuts, [256]])).astype(np.uint16)
+    return resolved, weights
+
+
+GAMMA_LUT8 = np.array([round(255 * (i / 255) ** 2.0) for i in range(256)], dtype=np.uint8)
+
+
+class HsvToRgbwTest(unittest.TestCase):
+
+    def check_matches_numpy(self, hsv_to_rgbw):
+        hues, sats, values, whites = random_hsv(1000)
+        for w in (None, whites):
+            for saturation in (0.0, 1.0, 2.0):
+                expected = colour_fast._hsv_to_rgbw_numpy(hues, sats, values, w, saturation, 0.8,
+                                                          np.empty((1000, 4), dtype=np.float32))
+                actual = hsv_to_rgbw(hues, sats, values, w, saturation, 0.8, np.empty((1000, 4), dtype=np.float32))
+                np.testing.assert_allclose(actual, expected, atol=1e-6)
+
+    def test_loop_matches_numpy(self):
+        self.check_matches_numpy(colour_fast._hsv_to_rgbw_loop)
+
+    @unittest.skipIf(colour_fast.njit is None, 'numba not installed')
+    def test_compiled_matches_numpy(self):
+        self.check_matches_numpy(colour_fast.hsv_to_rgbw)
+
+    def test_matches_colorsys(self):
+        hues, _, values, _ = random_hsv(1000)
+        out = colour_fast.hsv_to_rgbw(hues % 1.0, np.ones(1000), values, None, 1.0, 1.0,
+                                      np.empty((1000, 4), dtype=np.float32))
+        expected = [colorsys.hsv_to_rgb(h, 1.0, v) for h, v in zip(hues % 1.0, values)]
+        np.testing.assert_allclose(out[:, :3], expected, atol=1e-6)
+
+
+class RenderFrameTest(unittest.TestCase):
+
+    def check_matches_numpy(self, render_frame):
+        for k in (1, 2, 3):
+            resolved, weights = random_frame(k, 300, seed=k)
+            expected = colour_fast._render_frame_numpy(resolved, weights, GAMMA_LUT8,
+                                                       np.empty((300, 4), dtype=np.uint8))
+            actual = render_frame(resolved, weights, GAMMA_LUT8, np.empty((300, 4), dtype=np.uint8))
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_loop_matches_numpy(self):
+        self.check_matches_numpy(colour_fast._render_frame_loop)
+
+    @unittest.skipIf(colour_fast.njit is None, 'numba not installed')
+    def test_compiled_matches_numpy(self):
+        self.check_matches_numpy(colour_fast.render_frame)
+
+    def test_single_routine_gamma(self):
+        resolved = np.tile(np.arange(256, dtype=np.uint8)[:, None], (1, 1, 4))
+        out = colour_fast.render_frame(resolved, np.array([256], dtype=np.uint16), GAMMA_LUT8,
+                                       np.empty((256, 4), dtype=np.uint8))
+        # Gamma applies to r, g, b only, white passes straight through
+        np.testing.assert_array_equal(out[:, :3], np.tile(GAMMA_LUT8[:, None], (1, 3)))
+        np.testing.assert_array_equal(out[:, 3], np.arange(256))
+
+
+class ChannelOrderTest(unittest.TestCase):
+
+    def test_string_and_tuple_forms_agree(self):
+        for pixel_order, byte_positions in (('RGBW', (0, 1, 2, 3)),
+                                            ('GRBW', (1, 0, 2, 3)),
+                                            ('BRGW', (1, 2, 0, 3))):
+            np.testing.assert_array_equal(colour_fast.channel_order(pixel_order),
+                                          colour_fast.channel_order(byte_positions))
+
+    def test_reorders_channels(self):
+        pixels8 = np.array([[10, 20, 30, 40]], dtype=np.uint8)
+        self.assertEqual(pixels8[:, colour_fast.channel_order('GRBW')].tolist(), [[20, 10, 30, 40]])
+        self.assertEqual(pixels8[:, colour_fast.channel_order('BRGW')].tolist(), [[30, 10, 20, 40]])
+
+
+if __name__ == '__main__':
+    unittest.main()